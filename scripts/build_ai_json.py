@@ -3,7 +3,8 @@
 """
 Gera ai_analysis.json a partir de:
   data/execucoes.csv (projeto, job, exec_id, inicio, status, duracao_s)
-  data/score.csv     (exec_id, re)
+  data/score.csv     (exec_id, re[, is_anomaly, severity, limiar_nivel])
+Com is_anomaly no score, inclui a lista "anomalias" (por severidade decrescente).
 """
 
 import argparse, json, sys
@@ -11,6 +12,8 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 
+import thresholds   # aliases de cabeçalho do execucoes.csv
+
 def _fail(msg: str, code: int = 2):
     print(f"ERRO: {msg}", file=sys.stderr)
     sys.exit(code)
@@ -18,13 +21,7 @@ def _fail(msg: str, code: int = 2):
 def _read_execucoes(exec_path: Path) -> pd.DataFrame:
     df = pd.read_csv(exec_path, dtype=str, keep_default_na=False, na_values=["", "NA", "NaN"])
     # normaliza cabeçalhos comuns (aliases) -> nomes esperados
-    lower = {c.lower().strip(): c for c in df.columns}
-    rename = {}
-    if "project" in lower:      rename[lower["project"]]      = "projeto"
-    if "job_name" in lower:     rename[lower["job_name"]]     = "job"
-    if "start_time" in lower:   rename[lower["start_time"]]   = "inicio"
-    if "duration_sec" in lower: rename[lower["duration_sec"]] = "duracao_s"
-    df = df.rename(columns=rename)
+    df = df.rename(columns=thresholds.exec_column)
 
     required = ["projeto", "job", "exec_id", "inicio", "status", "duracao_s"]
     missing = [c for c in required if c not in df.columns]
@@ -49,12 +46,18 @@ def _read_score(score_path: Path) -> pd.DataFrame:
         _fail("Colunas obrigatórias ausentes em score.csv: exec_id, re")
     df["exec_id"] = df["exec_id"].astype(str).str.strip()
     df["re"] = pd.to_numeric(df["re"], errors="coerce")
+    # limiares por job (opcionais: só existem se o treino gerou models/thresholds.json)
+    if "is_anomaly" in df.columns:
+        df["is_anomaly"] = pd.to_numeric(df["is_anomaly"], errors="coerce").fillna(0).astype(int)
+    if "severity" in df.columns:
+        df["severity"] = pd.to_numeric(df["severity"], errors="coerce")
     df = df[df["exec_id"].notna() & (df["exec_id"] != "")]
     df = df[df["re"].notna()]
     return df
 
-def build_analysis(df_exec: pd.DataFrame, df_score: pd.DataFrame) -> dict:
-    df = df_exec.merge(df_score[["exec_id", "re"]], on="exec_id", how="left")
+def build_analysis(df_exec: pd.DataFrame, df_score: pd.DataFrame, max_anomalias: int = 500) -> dict:
+    flag_cols = [c for c in ("is_anomaly", "severity") if c in df_score.columns]
+    df = df_exec.merge(df_score[["exec_id", "re"] + flag_cols], on="exec_id", how="left")
 
     total = len(df)
     por_status = df["status"].fillna("desconhecido").value_counts(dropna=False).to_dict()
@@ -67,6 +70,9 @@ def build_analysis(df_exec: pd.DataFrame, df_score: pd.DataFrame) -> dict:
         "duracao_media_s": None if (duracao_med is None or np.isnan(duracao_med)) else duracao_med,
         "re_p95_global": re_p95_global,
     }
+    if "is_anomaly" in df_score:
+        # conta no score: o merge replica exec_id repetido no execucoes.csv
+        resumo["total_anomalias"] = int(df_score["is_anomaly"].sum())
 
     chave_job = ["projeto","job"] if all(c in df.columns for c in ["projeto","job"]) else ["job"]
     risco_p95_por_job = (
@@ -83,19 +89,38 @@ def build_analysis(df_exec: pd.DataFrame, df_score: pd.DataFrame) -> dict:
     hotspots = (
         df.dropna(subset=["re"])
           .sort_values("re", ascending=False)
-          .loc[:, ["projeto","job","exec_id","inicio","status","duracao_s","re"]]
+          .loc[:, ["projeto","job","exec_id","inicio","status","duracao_s","re"] + flag_cols]
           .head(50).to_dict(orient="records")
     )
     hotspots = [
         {"projeto":h.get("projeto"), "job":h.get("job"), "exec_id":h.get("exec_id"),
          "inicio":_ser(h.get("inicio")), "status":h.get("status"),
          "duracao_s": None if pd.isna(h.get("duracao_s")) else float(h.get("duracao_s")),
-         "re": float(h.get("re"))}
+         "re": float(h.get("re")),
+         **({"is_anomaly": bool(h["is_anomaly"]), "severity": float(h["severity"])} if flag_cols else {})}
         for h in hotspots
     ]
 
+    anomalias = []
+    if "is_anomaly" in df_score:
+        # uma linha por execução pontuada; projeto/job/... da 1ª ocorrência do exec_id
+        info = df_exec.drop_duplicates("exec_id")[["exec_id","projeto","job","inicio","status","duracao_s"]]
+        an = (df_score.loc[df_score["is_anomaly"] == 1, ["exec_id", "re"] + flag_cols]
+                .sort_values(["severity", "re"] if "severity" in flag_cols else ["re"], ascending=False)
+                .head(max_anomalias)
+                .merge(info, on="exec_id", how="left"))
+        anomalias = [
+            {"projeto":a.get("projeto"), "job":a.get("job"), "exec_id":a.get("exec_id"),
+             "inicio":_ser(a.get("inicio")), "status":_ser(a.get("status")),
+             "duracao_s": None if pd.isna(a.get("duracao_s")) else float(a.get("duracao_s")),
+             "re": float(a.get("re")),
+             "severity": None if pd.isna(a.get("severity")) else float(a.get("severity"))}
+            for a in an.to_dict(orient="records")
+        ]
+
     return {
         "resumo": resumo,
+        "anomalias": anomalias,
         "risco_p95_por_job": risco_p95_por_job,
         "hotspots": hotspots,
         "top_amostras": hotspots[:100],
@@ -105,6 +130,7 @@ def main():
     ap = argparse.ArgumentParser(description="Gera ai_analysis.json a partir de .csv em 'data/'.")
     ap.add_argument("--data-dir", default="data")
     ap.add_argument("--out", default="app/ai_analysis.json")  # padrão canônico
+    ap.add_argument("--max-anomalias", type=int, default=500, help="limite da lista 'anomalias'")
     args = ap.parse_args()
 
     data_dir = Path(args.data_dir)
@@ -119,7 +145,7 @@ def main():
     df_exec = _read_execucoes(exec_path)
     df_score = _read_score(score_path)
 
-    result = build_analysis(df_exec, df_score)
+    result = build_analysis(df_exec, df_score, max_anomalias=args.max_anomalias)
 
     out_path = Path(args.out)
     out_path.parent.mkdir(parents=True, exist_ok=True)
@@ -131,6 +157,7 @@ def main():
         "out": str(out_path),
         "resumo": result["resumo"],
         "counts": {
+            "anomalias": len(result["anomalias"]),
             "hotspots": len(result["hotspots"]),
             "risco_p95_por_job": len(result["risco_p95_por_job"]),
             "top_amostras": len(result["top_amostras"])
@@ -1,36 +1,62 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os
+import os, sqlite3
 from pathlib import Path
 import numpy as np
 import pandas as pd
-import joblib
 import json
 
+import rbm_lean
+import thresholds
+
 # Entradas/Saídas (podem ser sobrescritas por env vars)
 FEATS_CSV  = os.getenv("FEATS_CSV", "data/features.csv")
 SCALER_JOB = os.getenv("SCALER_JOB", "models/scalers.joblib")  # salvo no train_rbm.py
 RBM_JOB    = os.getenv("RBM_JOB", "models/rbm.joblib")
+LEAN_MODEL = os.getenv("LEAN_MODEL", "models/rbm_lean.npz")     # se atual, evita sklearn/joblib
 
 SCORE_CSV  = os.getenv("SCORE_CSV", "data/score.csv")          # <- requerido pelo build_ai_json.py
 OUT_JSON   = os.getenv("OUT_JSON", "app/ai_analysis.json")      # <- caminho canônico do painel
 
+EXECUCOES_CSV = os.getenv("EXECUCOES_CSV", "data/execucoes.csv")  # projeto/job/inicio por exec_id
+HISTORY_DB    = os.getenv("HISTORY_DB", "data/history.db")          # histórico SQLite; "" desliga
+
 def _ensure_exists(path: str | Path, kind: str):
     if not Path(path).exists():
         raise FileNotFoundError(f"{kind} não encontrado: {path}")
 
+def _lean_is_current() -> bool:
+    """
+    O .npz só vale se foi exportado exatamente do RBM_JOB + SCALER_JOB configurados (sha256
+    gravado no treino; mtime não serve após checkout). Sem os .joblib, o .npz é o modelo.
+    """
+    if not LEAN_MODEL or not Path(LEAN_MODEL).exists():
+        return False
+    fontes = [Path(RBM_JOB).exists(), Path(SCALER_JOB).exists()]
+    if not any(fontes):
+        return True
+    if not all(fontes):
+        return False
+    return rbm_lean.read_fingerprint(LEAN_MODEL) == rbm_lean.fingerprint(RBM_JOB, SCALER_JOB)
+
 def _load_inputs():
     _ensure_exists(FEATS_CSV, "CSV de features")
-    _ensure_exists(SCALER_JOB, "Scaler/metadata")
-    _ensure_exists(RBM_JOB, "Modelo RBM")
     df = pd.read_csv(FEATS_CSV)
-    meta = joblib.load(SCALER_JOB)
-    rbm  = joblib.load(RBM_JOB)
 
-    used_cols = meta.get("used_cols")
-    scaler    = meta.get("scaler")
-    if used_cols is None or scaler is None:
-        raise ValueError("models/scalers.joblib não possui 'used_cols' e/ou 'scaler'.")
+    if _lean_is_current():
+        model = rbm_lean.load(LEAN_MODEL)
+        used_cols, scaler, rbm = model["used_cols"], None, model
+    else:
+        import joblib   # só no caminho legado: unpickle de sklearn é o custo dominante
+        _ensure_exists(SCALER_JOB, "Scaler/metadata")
+        _ensure_exists(RBM_JOB, "Modelo RBM")
+        meta = joblib.load(SCALER_JOB)
+        rbm  = joblib.load(RBM_JOB)
+
+        used_cols = meta.get("used_cols")
+        scaler    = meta.get("scaler")
+        if used_cols is None or scaler is None:
+            raise ValueError("models/scalers.joblib não possui 'used_cols' e/ou 'scaler'.")
 
     if not all(c in df.columns for c in used_cols):
         faltando = [c for c in used_cols if c not in df.columns]
@@ -48,11 +74,67 @@ def _prepare_matrix(df: pd.DataFrame, used_cols, scaler):
         # imputação mediana
         med = X[c].median(skipna=True)
         X[c] = X[c].fillna(med)
+    if scaler is None:
+        return X.values.astype(np.float64)
     # escala igual ao treino e clipa a [0,1]
     Xn = scaler.transform(X.values.astype(np.float64))
     Xn = np.clip(Xn, 0.0, 1.0)
     return Xn
 
+def _reconstruction_error(X: np.ndarray, scaler, rbm) -> np.ndarray:
+    if scaler is None:
+        # modelo enxuto: mesmo MinMax + passo de Gibbs, só com NumPy
+        Xn = rbm_lean.prepare_matrix(X, rbm)
+        return rbm_lean.reconstruction_error(Xn, rbm)
+    # Reconstrução (usando passo de Gibbs do RBM)
+    V_recon = rbm.gibbs(X)
+    return np.mean((X - V_recon) ** 2, axis=1)
+
+def _read_exec_keys() -> pd.DataFrame | None:
+    if not Path(EXECUCOES_CSV).exists():
+        print(f"[warn] {EXECUCOES_CSV} ausente; sem limiar por job e sem histórico.")
+        return None
+    try:
+        return thresholds.read_exec_keys(EXECUCOES_CSV)
+    except (OSError, ValueError) as e:   # ParserError/EmptyDataError são ValueError
+        print(f"[warn] {EXECUCOES_CSV} ilegível ({e}); sem limiar por job e sem histórico.")
+        return None
+
+def _flag_anomalies(out_df: pd.DataFrame, ex: pd.DataFrame | None) -> pd.DataFrame:
+    """Acrescenta is_anomaly/severity/limiar_nivel com os limiares aprendidos no treino."""
+    if not thresholds.THRESHOLDS_PATH or not Path(thresholds.THRESHOLDS_PATH).exists():
+        print(f"[warn] Limiares não encontrados ({thresholds.THRESHOLDS_PATH}); sem is_anomaly.")
+        return out_df
+    keys = out_df[["exec_id", "re"]]
+    if ex is not None:
+        keys = keys.merge(ex[["exec_id", "projeto", "job"]], on="exec_id", how="left")
+    else:
+        keys = keys.assign(projeto=np.nan, job=np.nan)
+    flags = thresholds.apply(keys, thresholds.load(thresholds.THRESHOLDS_PATH))
+    return pd.concat([out_df, flags.set_axis(out_df.index)], axis=1)
+
+def _append_history(out_df: pd.DataFrame, ex: pd.DataFrame | None):
+    """Acrescenta os scores ao histórico local, com projeto/job/inicio vindos do execucoes.csv."""
+    if not HISTORY_DB or ex is None:
+        return
+    import history_store
+
+    hist = out_df[["exec_id", "re"]].merge(ex, on="exec_id", how="inner")
+    # histórico é auxiliar: banco antigo/travado ou datas ruins não derrubam a detecção
+    try:
+        conn = history_store.connect(HISTORY_DB)
+        try:
+            n = history_store.insert_scores(conn, hist)
+            removidas = history_store.apply_retention(conn)
+        finally:
+            conn.close()
+    except (sqlite3.Error, RuntimeError, ValueError, OSError) as e:
+        print(f"[warn] Histórico {HISTORY_DB} não atualizado: {e}")
+        return
+    print(f"[detect_anomalies] Histórico {HISTORY_DB}: +{n} linhas novas "
+          f"({len(hist) - n} já registradas)"
+          + (f", {removidas} removidas pela retenção." if removidas else "."))
+
 def main():
     df, used_cols, scaler, rbm = _load_inputs()
 
@@ -63,22 +145,25 @@ def main():
         id_col = "exec_id"
 
     X = _prepare_matrix(df, used_cols, scaler)
-
-    # Reconstrução (usando passo de Gibbs do RBM)
-    V_recon = rbm.gibbs(X)
-    re = np.mean((X - V_recon) ** 2, axis=1)
+    re = _reconstruction_error(X, scaler, rbm)
 
     # Salva score.csv para o build final
     out_df = pd.DataFrame({"exec_id": df[id_col].astype(str), "re": re.astype(float)})
+    ex = _read_exec_keys()
+    out_df = _flag_anomalies(out_df, ex)
     Path(SCORE_CSV).parent.mkdir(parents=True, exist_ok=True)
     out_df.to_csv(SCORE_CSV, index=False)
     print(f"[detect_anomalies] Gravado {SCORE_CSV} com {len(out_df)} linhas.")
 
+    _append_history(out_df, ex)
+
     # (opcional) JSON leve no caminho canônico; o build_ai_json.py sobrescreve depois com o layout completo
     resumo = {
         "total_execucoes": int(len(out_df)),
         "re_p95_global": float(np.percentile(re, 95)) if len(out_df) else None
     }
+    if "is_anomaly" in out_df:
+        resumo["total_anomalias"] = int(out_df["is_anomaly"].sum())
     payload = {"resumo": resumo, "scores_sample": out_df.head(10).to_dict(orient="records")}
     Path(OUT_JSON).parent.mkdir(parents=True, exist_ok=True)
     with open(OUT_JSON, "w", encoding="utf-8") as f:
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Histórico local de execuções pontuadas (SQLite embarcado).
+
+Cada rodada do detect_anomalies.py acrescenta (projeto, job, exec_id, inicio, re)
+em data/history.db, permitindo consultar a evolução do RE sem repontuar:
+  python scripts/history_store.py range --projeto P --job J --desde 2025-09-01
+  python scripts/history_store.py p95 --bucket day --job J
+  python scripts/history_store.py retention --days 90
+  python scripts/history_store.py compact
+
+Cada execução guarda o RE da primeira vez em que foi pontuada (modelo vigente na época);
+repontuar o mesmo features.csv não sobrescreve o histórico. Os quantis por hora/dia saem
+de tabelas de rollup (contagem + histograma de RE) atualizadas no insert, sem varrer scores.
+"""
+
+import argparse, json, os, sqlite3, sys, time
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+HISTORY_DB        = os.getenv("HISTORY_DB", "data/history.db")
+RETENTION_DAYS    = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))     # 0 = mantém tudo
+PARTITION         = os.getenv("HISTORY_PARTITION", "month")           # "month" | "day"
+INSERT_CHUNK      = int(os.getenv("HISTORY_INSERT_CHUNK", "50000"))
+
+_EPOCH = datetime(1970, 1, 1)
+_BUCKETS = {"hour": 3600, "day": 86400}
+_PARTITION_FMT = {"month": "%Y-%m", "day": "%Y-%m-%d"}
+_HIST_BINS = 1000   # RE em [0,1] -> quantis dos rollups com resolução de 0,001
+_RE_PROBE  = 100000 # re_min com menos linhas que isso vai pelo ix_scores_re
+
+_ROLLUP = """
+CREATE TABLE IF NOT EXISTS rollup_{b} (
+    projeto TEXT    NOT NULL,
+    job     TEXT    NOT NULL,
+    balde   INTEGER NOT NULL,   -- início do balde (epoch)
+    n       INTEGER NOT NULL,
+    soma    REAL    NOT NULL,
+    re_max  REAL    NOT NULL,
+    hist    BLOB    NOT NULL,   -- pares uint32 (bin, contagem), bins em ordem crescente
+    PRIMARY KEY (projeto, job, balde)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_rollup_{b}_job ON rollup_{b} (job, balde);
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    projeto  TEXT    NOT NULL,
+    job      TEXT    NOT NULL,
+    inicio   INTEGER NOT NULL,   -- epoch (s, UTC ingênuo)
+    exec_id  TEXT    NOT NULL,
+    seq      INTEGER NOT NULL,   -- ordinal entre linhas com a mesma chave (exec_id do ETL não é único)
+    re       REAL    NOT NULL,
+    particao TEXT    NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_scores_chave ON scores (projeto, job, inicio, exec_id, seq);
+CREATE INDEX IF NOT EXISTS ix_scores_job_inicio ON scores (job, inicio);
+CREATE INDEX IF NOT EXISTS ix_scores_particao ON scores (particao);
+CREATE INDEX IF NOT EXISTS ix_scores_re ON scores (re);
+""" + "".join(_ROLLUP.format(b=b) for b in _BUCKETS)
+
+def connect(path: str | Path = HISTORY_DB) -> sqlite3.Connection:
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path))
+    # auto_vacuum só vale se definido antes da primeira tabela
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-262144")   # 256 MiB de cache p/ bulk insert e índices
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(scores)")]
+    if cols and "seq" not in cols:
+        conn.close()
+        raise RuntimeError(f"{path} usa o layout antigo (sem seq/rollups); remova o arquivo para recriar.")
+    conn.executescript(_SCHEMA)
+    return conn
+
+def _to_epoch(value) -> int | None:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    s = str(value).strip()
+    if s.isdigit():
+        return int(s)
+    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return int((datetime.strptime(s, fmt) - _EPOCH).total_seconds())
+        except ValueError:
+            continue
+    raise ValueError(f"Data inválida: {value!r} (use YYYY-MM-DD[ HH:MM:SS] ou epoch)")
+
+def _decode(blobs) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Histogramas esparsos -> (linha, bin, contagem) achatados, na ordem dos blobs."""
+    lens = np.fromiter((len(b) // 8 for b in blobs), dtype=np.int64, count=len(blobs))
+    pares = np.frombuffer(b"".join(blobs), dtype="<u4").reshape(-1, 2).astype(np.int64)
+    return np.repeat(np.arange(len(blobs)), lens), pares[:, 0], pares[:, 1]
+
+def _update_rollups(conn: sqlite3.Connection, novos):
+    """Soma as linhas novas aos rollups de hora/dia (merge com o histograma já gravado)."""
+    import pandas as pd
+    keys = ["projeto", "job", "balde"]
+    bins = np.clip((novos["re"].to_numpy() * _HIST_BINS).astype(np.int64), 0, _HIST_BINS - 1)
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _chaves (projeto TEXT, job TEXT, balde INTEGER)")
+    for nome, step in _BUCKETS.items():
+        d = pd.DataFrame({"projeto": novos["projeto"].to_numpy(), "job": novos["job"].to_numpy(),
+                          "balde": novos["inicio"].to_numpy() // step * step,
+                          "bin": bins, "re": novos["re"].to_numpy()})
+        agg = d.groupby(keys).agg(n=("re", "size"), soma=("re", "sum"), re_max=("re", "max")).reset_index()
+        hist = d.groupby(keys + ["bin"]).size().rename("cont").reset_index()
+
+        conn.execute("DELETE FROM _chaves")
+        conn.executemany("INSERT INTO _chaves VALUES (?, ?, ?)",
+                         zip(agg["projeto"], agg["job"], agg["balde"].tolist()))
+        old = conn.execute(f"""
+            SELECT r.projeto, r.job, r.balde, r.n, r.soma, r.re_max, r.hist
+            FROM _chaves k JOIN rollup_{nome} r
+              ON r.projeto = k.projeto AND r.job = k.job AND r.balde = k.balde""").fetchall()
+        if old:
+            o = pd.DataFrame(old, columns=keys + ["n", "soma", "re_max", "hist"])
+            row, b, c = _decode(o["hist"].tolist())
+            o_hist = o.loc[row, keys].reset_index(drop=True).assign(bin=b, cont=c)
+            agg = (pd.concat([agg, o[keys + ["n", "soma", "re_max"]]])
+                     .groupby(keys).agg(n=("n", "sum"), soma=("soma", "sum"), re_max=("re_max", "max"))
+                     .reset_index())
+            hist = pd.concat([hist, o_hist]).groupby(keys + ["bin"])["cont"].sum().reset_index()
+
+        # hist e agg ordenados pelas mesmas chaves -> fatia contígua de pares por chave
+        off = np.r_[0, np.cumsum(hist.groupby(keys).size().to_numpy())] * 8
+        buf = np.column_stack([hist["bin"], hist["cont"]]).astype("<u4").tobytes()
+        blobs = [buf[a:z] for a, z in zip(off[:-1], off[1:])]
+        conn.executemany(
+            f"INSERT OR REPLACE INTO rollup_{nome} (projeto, job, balde, n, soma, re_max, hist) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            zip(agg["projeto"], agg["job"], agg["balde"].tolist(), agg["n"].tolist(),
+                agg["soma"].tolist(), agg["re_max"].tolist(), blobs))
+
+def insert_scores(conn: sqlite3.Connection, df) -> int:
+    """
+    Bulk insert de um DataFrame com projeto, job, exec_id, inicio (datetime64), re.
+    Só grava execuções ainda ausentes (o RE já registrado é mantido) e atualiza os rollups
+    com elas. Retorna o número de linhas efetivamente novas.
+    """
+    import pandas as pd
+    d = df.dropna(subset=["inicio", "re"])
+    if d.empty:
+        return 0
+    # offsets/"Z" do ETL (dateutil) -> UTC ingênuo, como a coluna inicio do schema
+    inicio = pd.to_datetime(d["inicio"], utc=True).dt.tz_convert(None)
+    d = pd.DataFrame({
+        "projeto": d["projeto"].astype(str).to_numpy(), "job": d["job"].astype(str).to_numpy(),
+        "inicio": ((inicio - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)).astype("int64").to_numpy(),
+        "exec_id": d["exec_id"].astype(str).to_numpy(), "re": d["re"].astype(float).to_numpy(),
+        "particao": inicio.dt.strftime(_PARTITION_FMT.get(PARTITION, "%Y-%m")).to_numpy(),
+    })
+    # linhas distintas com a mesma chave (hash projeto|job|inicio do ETL) viram seq 0, 1, ...
+    d["seq"] = d.groupby(["projeto", "job", "inicio", "exec_id"]).cumcount()
+    # ordem do índice principal -> inserções quase sequenciais nas páginas da B-tree
+    d = d.sort_values(["projeto", "job", "inicio", "exec_id", "seq"], kind="stable")
+    cols = ["projeto", "job", "inicio", "exec_id", "seq", "re", "particao"]
+
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _lote "
+                 "(projeto TEXT, job TEXT, inicio INTEGER, exec_id TEXT, seq INTEGER, re REAL, particao TEXT)")
+    with conn:
+        conn.execute("DELETE FROM _lote")
+        for s in range(0, len(d), INSERT_CHUNK):
+            b = d.iloc[s:s + INSERT_CHUNK]
+            conn.executemany("INSERT INTO _lote VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             zip(*(b[c].tolist() for c in cols)))
+        conn.execute("""
+            DELETE FROM _lote WHERE EXISTS (
+                SELECT 1 FROM scores s
+                WHERE s.projeto = _lote.projeto AND s.job = _lote.job AND s.inicio = _lote.inicio
+                  AND s.exec_id = _lote.exec_id AND s.seq = _lote.seq)""")
+        conn.execute(f"INSERT INTO scores ({', '.join(cols)}) SELECT {', '.join(cols)} FROM _lote")
+        novos = pd.DataFrame(conn.execute("SELECT projeto, job, inicio, re FROM _lote").fetchall(),
+                             columns=["projeto", "job", "inicio", "re"])
+        if len(novos):
+            _update_rollups(conn, novos)
+    return len(novos)
+
+def _where(projeto=None, job=None, desde=None, ate=None, col="inicio"):
+    clauses, params = [], []
+    if projeto is not None: clauses.append("projeto = ?"); params.append(projeto)
+    if job is not None:     clauses.append("job = ?");     params.append(job)
+    if desde is not None:   clauses.append(f"{col} >= ?"); params.append(_to_epoch(desde))
+    if ate is not None:     clauses.append(f"{col} < ?");  params.append(_to_epoch(ate))
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+def _iso(epoch: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(epoch))
+
+def query_range(conn: sqlite3.Connection, projeto=None, job=None, desde=None, ate=None,
+                re_min: float | None = None, limit: int | None = None) -> list[dict]:
+    where, params = _where(projeto, job, desde, ate)
+    indice = ""
+    if re_min is not None:
+        where += (" AND " if where else " WHERE ") + "re >= ?"
+        params.append(re_min)
+        # sem STAT4 o planner não sabe que re >= x é seletivo e varre ix_scores_chave pelo
+        # ORDER BY; uma sonda limitada no índice de re decide
+        n = conn.execute("SELECT count(*) FROM (SELECT 1 FROM scores INDEXED BY ix_scores_re "
+                         "WHERE re >= ? LIMIT ?)", (re_min, _RE_PROBE)).fetchone()[0]
+        if n < _RE_PROBE:
+            indice = " INDEXED BY ix_scores_re"
+    sql = f"SELECT projeto, job, exec_id, inicio, re FROM scores{indice}{where} ORDER BY projeto, job, inicio"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return [{"projeto": p, "job": j, "exec_id": e, "inicio": _iso(i), "re": r}
+            for p, j, e, i, r in conn.execute(sql, params)]
+
+def bucket_quantile(conn: sqlite3.Connection, bucket: str = "day", q: float = 0.95,
+                    projeto=None, job=None, desde=None, ate=None) -> list[dict]:
+    """
+    Quantil (nearest-rank, resolução 1/_HIST_BINS) de RE por (projeto, job, balde de hora/dia),
+    lido dos rollups: custo proporcional ao número de baldes, não de execuções.
+    """
+    if bucket not in _BUCKETS:
+        raise ValueError(f"bucket inválido: {bucket} (use {', '.join(_BUCKETS)})")
+    if not 0.0 < q <= 1.0:
+        raise ValueError(f"quantil fora de (0, 1]: {q}")
+    where, params = _where(projeto, job, desde, ate, col="balde")
+    rows = conn.execute(f"SELECT projeto, job, balde, n, soma, re_max, hist FROM rollup_{bucket}{where} "
+                        "ORDER BY projeto, job, balde", params).fetchall()
+    if not rows:
+        return []
+    proj, jobs, baldes, ns, somas, maxs, blobs = zip(*rows)
+    n = np.asarray(ns, dtype=np.int64)
+    row, b, c = _decode(blobs)
+    # contagem acumulada dentro de cada balde; 1º bin que alcança o rank ceil(q·n)
+    acum = np.cumsum(c) - np.r_[0, np.cumsum(n)[:-1]][row]
+    rank = np.maximum(1, np.ceil(np.round(q * n, 9))).astype(np.int64)
+    hit = np.flatnonzero(acum >= rank[row])
+    first = hit[np.r_[True, np.diff(row[hit]) > 0]]
+    val = np.minimum((b[first] + 0.5) / _HIST_BINS, np.asarray(maxs))
+    chave = f"re_p{q * 100:g}"   # 0.995 -> re_p99.5
+    return [{"projeto": p, "job": j, "balde": _iso(bd), "n": int(k), chave: float(v),
+             "re_media": sm / k, "re_max": mx}
+            for p, j, bd, k, v, sm, mx in zip(proj, jobs, baldes, n, val, somas, maxs)]
+
+def apply_retention(conn: sqlite3.Connection, days: int = RETENTION_DAYS) -> int:
+    """Remove partições (e rollups) inteiramente anteriores a agora - days e libera páginas livres."""
+    if days <= 0:
+        return 0
+    fmt = _PARTITION_FMT.get(PARTITION, "%Y-%m")
+    corte = time.strftime(fmt, time.gmtime(time.time() - days * 86400))
+    corte_epoch = int((datetime.strptime(corte, fmt) - _EPOCH).total_seconds())
+    with conn:
+        cur = conn.execute("DELETE FROM scores WHERE particao < ?", (corte,))
+        for b in _BUCKETS:
+            conn.execute(f"DELETE FROM rollup_{b} WHERE balde < ?", (corte_epoch,))
+    conn.execute("PRAGMA incremental_vacuum")
+    return cur.rowcount
+
+def compact(conn: sqlite3.Connection):
+    """Compactação completa (reescreve o arquivo) + estatísticas do planner."""
+    conn.execute("ANALYZE")
+    conn.execute("VACUUM")
+
+def main():
+    ap = argparse.ArgumentParser(description="Consulta/manutenção do histórico de scores (SQLite).")
+    ap.add_argument("--db", default=HISTORY_DB)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    def _filtros(p):
+        p.add_argument("--projeto"); p.add_argument("--job")
+        p.add_argument("--desde", help="YYYY-MM-DD[ HH:MM:SS] (inclusivo)")
+        p.add_argument("--ate", help="YYYY-MM-DD[ HH:MM:SS] (exclusivo)")
+
+    p_range = sub.add_parser("range", help="execuções em um intervalo")
+    _filtros(p_range)
+    p_range.add_argument("--re-min", type=float)
+    p_range.add_argument("--limit", type=int, default=1000)
+
+    p_q = sub.add_parser("p95", help="quantil de RE por job e balde de tempo")
+    _filtros(p_q)
+    p_q.add_argument("--bucket", choices=sorted(_BUCKETS), default="day")
+    p_q.add_argument("--q", type=float, default=0.95)
+
+    p_ret = sub.add_parser("retention", help="remove partições antigas")
+    p_ret.add_argument("--days", type=int, default=RETENTION_DAYS)
+
+    sub.add_parser("compact", help="VACUUM + ANALYZE")
+    args = ap.parse_args()
+
+    if not Path(args.db).exists():
+        print(f"ERRO: histórico não encontrado: {args.db}", file=sys.stderr)
+        sys.exit(2)
+    conn = connect(args.db)
+    try:
+        if args.cmd == "range":
+            out = query_range(conn, args.projeto, args.job, args.desde, args.ate, args.re_min, args.limit)
+        elif args.cmd == "p95":
+            out = bucket_quantile(conn, args.bucket, args.q, args.projeto, args.job, args.desde, args.ate)
+        elif args.cmd == "retention":
+            out = {"removidas": apply_retention(conn, args.days)}
+        else:
+            compact(conn)
+            out = {"status": "ok"}
+    finally:
+        conn.close()
+    print(json.dumps(out, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
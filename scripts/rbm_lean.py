@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Modelo RBM "enxuto" (.npz) e pontuação só com NumPy.
+
+O train_rbm.py exporta pesos, vieses, min/scale do MinMaxScaler, used_cols e o estado
+do gerador aleatório da RBM em models/rbm_lean.npz. Este script pontua features.csv
+sem importar pandas/sklearn/joblib (partida rápida para lotes pequenos via webhook)
+e grava data/score.csv no mesmo layout do detect_anomalies.py, inclusive
+is_anomaly/severity/limiar_nivel quando há models/thresholds.json (só json + dict):
+  python scripts/rbm_lean.py
+"""
+
+import csv, hashlib, os, warnings
+from pathlib import Path
+import numpy as np
+
+import thresholds   # lookup dos limiares sem pandas
+
+FEATS_CSV  = os.getenv("FEATS_CSV", "data/features.csv")
+LEAN_MODEL = os.getenv("LEAN_MODEL", "models/rbm_lean.npz")
+SCORE_CSV  = os.getenv("SCORE_CSV", "data/score.csv")
+EXECUCOES_CSV   = os.getenv("EXECUCOES_CSV", "data/execucoes.csv")
+
+def to_model(rbm, scaler, used_cols: list[str]) -> dict:
+    """Extrai da RBM/scaler do sklearn o mesmo dicionário que load() devolve."""
+    # fit() não guarda random_state_: o gibbs() do modelo carregado parte da semente
+    rng = getattr(rbm, "random_state_", None)
+    if rng is None:
+        rng = np.random.RandomState(rbm.random_state)
+    kind, keys, pos, has_gauss, cached = rng.get_state()
+    return {
+        "components": rbm.components_, "intercept_hidden": rbm.intercept_hidden_,
+        "intercept_visible": rbm.intercept_visible_,
+        "scaler_min": scaler.min_, "scaler_scale": scaler.scale_,
+        "used_cols": list(used_cols),
+        "rng_keys": keys, "rng_pos": pos, "rng_has_gauss": has_gauss, "rng_cached_gaussian": cached,
+    }
+
+def fingerprint(*paths: str | Path) -> str:
+    """sha256 do conteúdo dos arquivos (rbm.joblib, scalers.joblib) de onde o .npz foi exportado."""
+    h = hashlib.sha256()
+    for p in paths:
+        with open(p, "rb") as f:
+            for bloco in iter(lambda: f.read(1 << 20), b""):
+                h.update(bloco)
+    return h.hexdigest()
+
+def read_fingerprint(path: str | Path = LEAN_MODEL) -> str | None:
+    """Fingerprint gravado no export (None em .npz antigo, sem o campo)."""
+    with np.load(path, allow_pickle=False) as z:
+        return str(z["origem_sha256"]) if "origem_sha256" in z.files else None
+
+def export(path: str | Path, model: dict):
+    """Grava o modelo (to_model, opcionalmente com origem_sha256) num .npz (sem pickle)."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    np.savez(path, **{**model, "used_cols": np.asarray(model["used_cols"], dtype=str)})
+
+def load(path: str | Path = LEAN_MODEL) -> dict:
+    with np.load(path, allow_pickle=False) as z:
+        model = {k: z[k] for k in z.files}
+    model["used_cols"] = [str(c) for c in model["used_cols"]]
+    return model
+
+def make_rng(model: dict) -> np.random.RandomState:
+    # mesmo estado que o rbm.joblib carrega -> mesmas amostras de Gibbs
+    rng = np.random.RandomState()
+    rng.set_state(("MT19937", model["rng_keys"], int(model["rng_pos"]),
+                   int(model["rng_has_gauss"]), float(model["rng_cached_gaussian"])))
+    return rng
+
+def _expit(x: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        return 1.0 / (1.0 + np.exp(-x))
+
+def prepare_matrix(X: np.ndarray, model: dict) -> np.ndarray:
+    """Imputa mediana por coluna, aplica o MinMax do treino e clipa a [0,1]."""
+    X = np.array(X, dtype=np.float64)
+    nan = np.isnan(X)
+    if nan.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)   # coluna toda NaN -> segue NaN
+            X = np.where(nan, np.nanmedian(X, axis=0), X)
+    Xn = X * model["scaler_scale"] + model["scaler_min"]
+    return np.clip(Xn, 0.0, 1.0)
+
+def reconstruction_error(Xn: np.ndarray, model: dict,
+                         rng: np.random.RandomState | None = None) -> np.ndarray:
+    """
+    RE = mean((V - gibbs(V))²), equivalente ao BernoulliRBM.gibbs do sklearn.
+    Passe o mesmo rng (make_rng) para pontuar em blocos sem repetir amostras.
+    """
+    rng = make_rng(model) if rng is None else rng
+    W = model["components"]
+    p_h = _expit(Xn @ W.T + model["intercept_hidden"])
+    h = rng.uniform(size=p_h.shape) < p_h
+    p_v = _expit(h @ W + model["intercept_visible"])
+    v = rng.uniform(size=p_v.shape) < p_v
+    return np.mean((Xn - v) ** 2, axis=1)
+
+def _to_float(s: str) -> float:
+    try:
+        return float(s.replace(",", "."))
+    except ValueError:
+        return np.nan
+
+def read_features(path: str | Path, used_cols: list[str]) -> tuple[list[str], np.ndarray]:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        faltando = [c for c in used_cols if c not in header]
+        if faltando:
+            raise ValueError(f"Colunas de features ausentes no features.csv: {faltando}")
+        pos = [header.index(c) for c in used_cols]
+        id_pos = header.index("exec_id") if "exec_id" in header else None
+        ids, rows = [], []
+        for i, r in enumerate(reader):
+            ids.append(r[id_pos].strip() if id_pos is not None else str(i))
+            rows.append([_to_float(r[p]) for p in pos])
+    X = np.array(rows, dtype=np.float64).reshape(len(rows), len(used_cols))
+    return ids, X
+
+def read_exec_keys(path: str | Path) -> dict:
+    """exec_id -> (projeto, job) da primeira ocorrência; vazio vira None (como NaN no pandas)."""
+    keys = {}
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        reader.fieldnames = [thresholds.exec_column(c) for c in reader.fieldnames or []]
+        faltando = [c for c in ("projeto", "job", "exec_id") if c not in reader.fieldnames]
+        if faltando:
+            raise ValueError(f"Coluna obrigatória ausente em {path}: {', '.join(faltando)}")
+        for r in reader:
+            eid = (r.get("exec_id") or "").strip()
+            if eid not in keys:
+                keys[eid] = (r.get("projeto") or None, r.get("job") or None)
+    return keys
+
+def main():
+    for path, kind in ((FEATS_CSV, "CSV de features"), (LEAN_MODEL, "Modelo RBM (.npz)")):
+        if not Path(path).exists():
+            raise FileNotFoundError(f"{kind} não encontrado: {path}")
+    model = load(LEAN_MODEL)
+    ids, X = read_features(FEATS_CSV, model["used_cols"])
+    re = reconstruction_error(prepare_matrix(X, model), model)
+
+    header, cols = ["exec_id", "re"], [ids, re.tolist()]
+    if thresholds.THRESHOLDS_PATH and Path(thresholds.THRESHOLDS_PATH).exists():
+        thr = thresholds.load(thresholds.THRESHOLDS_PATH)
+        keys = {}
+        try:
+            keys = read_exec_keys(EXECUCOES_CSV)
+        except (OSError, ValueError, csv.Error) as e:
+            print(f"[warn] {EXECUCOES_CSV} ilegível ({e}); só o limiar global.")
+        projeto, job = zip(*(keys.get(eid, (None, None)) for eid in ids)) if ids else ((), ())
+        is_anom, sev, nivel = thresholds.flag(projeto, job, re, thr)
+        header += ["is_anomaly", "severity", "limiar_nivel"]
+        cols += [is_anom.tolist(), sev.tolist(), nivel]
+    else:
+        print(f"[warn] Limiares não encontrados ({thresholds.THRESHOLDS_PATH}); sem is_anomaly.")
+
+    Path(SCORE_CSV).parent.mkdir(parents=True, exist_ok=True)
+    with open(SCORE_CSV, "w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f, lineterminator="\n")   # mesmo fim de linha do to_csv
+        w.writerow(header)
+        w.writerows(zip(*cols))
+    print(f"[rbm_lean] Gravado {SCORE_CSV} com {len(ids)} linhas.")
+
+if __name__ == "__main__":
+    main()
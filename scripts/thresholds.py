@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Limiares adaptativos de RE por (projeto, job): mediana + k·MAD (robusto a outliers).
+
+Aprendidos no train_rbm.py sobre o RE do próprio conjunto de treino e gravados em
+models/thresholds.json. Grupos com poucas execuções (ou MAD zero) caem para o limiar
+do projeto e, por fim, para o global. A busca (flag) é um lookup em dicionário, sem
+pandas: o detect_anomalies.py e o rbm_lean.py usam a mesma regra. pandas só é
+importado nas funções de ajuste/leitura (partida rápida do rbm_lean).
+
+No treino em streaming o ajuste usa reservatórios de tamanho fixo por grupo
+(new_accumulator/update/finish): memória limitada por grupos × THRESH_SAMPLE,
+mediana/MAD exatos para grupos com até THRESH_SAMPLE execuções.
+"""
+
+import json, os
+from pathlib import Path
+import numpy as np
+
+THRESHOLDS_PATH = os.getenv("THRESHOLDS_PATH", "models/thresholds.json")
+THRESH_K        = float(os.getenv("THRESH_K", "3.0"))     # limiar = mediana + k * MAD normalizado
+THRESH_MIN_N    = int(os.getenv("THRESH_MIN_N", "30"))    # mínimo de execuções por grupo
+THRESH_SAMPLE   = int(os.getenv("THRESH_SAMPLE", "2000")) # reservatório por grupo (modo streaming)
+
+_MAD_SCALE = 1.4826   # MAD -> desvio-padrão equivalente (normal)
+
+# aliases de cabeçalho aceitos no execucoes.csv (mesmos para detect, rbm_lean e build_ai_json)
+EXEC_ALIASES = {"project": "projeto", "job_name": "job", "start_time": "inicio", "duration_sec": "duracao_s"}
+
+def exec_column(c: str) -> str:
+    """Nome esperado para um cabeçalho do execucoes.csv (project -> projeto, ...)."""
+    return EXEC_ALIASES.get(c.lower().strip(), c)
+
+def read_exec_columns(path: str | Path, cols: list[str], **kw):
+    """
+    read_csv (dtype=str) só das colunas `cols`, aceitando os aliases de cabeçalho.
+    Com chunksize devolve um iterador de DataFrames. ValueError se faltar coluna.
+    """
+    import pandas as pd
+    header = [exec_column(c) for c in pd.read_csv(path, nrows=0).columns]
+    faltando = [c for c in cols if c not in header]
+    if faltando:
+        raise ValueError(f"Coluna obrigatória ausente em {path}: {', '.join(faltando)}")
+    df = pd.read_csv(path, dtype=str, usecols=lambda c: exec_column(c) in cols, **kw)
+    if "chunksize" in kw:
+        return (c.rename(columns=exec_column) for c in df)
+    return df.rename(columns=exec_column)
+
+def read_exec_keys(path: str | Path):
+    """DataFrame projeto/job/inicio por exec_id (primeira ocorrência), a partir do execucoes.csv do ETL."""
+    import pandas as pd
+    ex = read_exec_columns(path, ["projeto", "job", "exec_id", "inicio"])
+    ex["exec_id"] = ex["exec_id"].astype(str).str.strip()
+    # etl grava ISO; offsets mistos ("Z", -03:00) viram UTC ingênuo
+    ex["inicio"] = pd.to_datetime(ex["inicio"], errors="coerce", format="ISO8601", utc=True).dt.tz_convert(None)
+    return ex.drop_duplicates("exec_id")
+
+def _group_stats(df, keys: list[str], k: float, min_n: int):
+    import pandas as pd
+    g = df.groupby(keys)["re"]
+    med = g.transform("median")
+    stats = pd.DataFrame({
+        "n": g.size(),
+        "median": g.median(),
+        "scale": (df["re"] - med).abs().groupby([df[c] for c in keys]).median() * _MAD_SCALE,
+    })
+    stats = stats[(stats["n"] >= min_n) & (stats["scale"] > 0)]
+    stats["thr"] = stats["median"] + k * stats["scale"]
+    return stats.reset_index()
+
+def fit_thresholds(df, k: float = THRESH_K, min_n: int = THRESH_MIN_N) -> dict:
+    """df (DataFrame): projeto, job, re (projeto/job nulos contam só no global)."""
+    re = df["re"].to_numpy(dtype=np.float64)
+    re = re[np.isfinite(re)]
+    if not len(re):
+        raise ValueError("Sem RE válido para calcular limiares.")
+    med = float(np.median(re))
+    # global sempre existe: MAD zero cai para desvio-padrão
+    scale = _MAD_SCALE * float(np.median(np.abs(re - med))) or float(np.std(re)) or 1e-12
+    d = df.dropna(subset=["re"])
+    return {
+        "k": k,
+        "min_n": min_n,
+        "global": {"n": int(len(re)), "median": med, "scale": scale, "thr": med + k * scale},
+        "projeto": _group_stats(d, ["projeto"], k, min_n).to_dict(orient="records"),
+        "job": _group_stats(d, ["projeto", "job"], k, min_n).to_dict(orient="records"),
+    }
+
+def _robust(vals: np.ndarray) -> tuple[float, float]:
+    med = float(np.median(vals))
+    return med, _MAD_SCALE * float(np.median(np.abs(vals - med)))
+
+def new_accumulator(seed: int = 0, sample: int = THRESH_SAMPLE) -> dict:
+    """Estado do ajuste em streaming: um reservatório (n, valores, chaves) por nível/grupo."""
+    return {"rng": np.random.RandomState(seed), "sample": sample,
+            "global": None, "projeto": {}, "job": {}}
+
+def _reservoir_add(res: dict | None, vals: np.ndarray, acc: dict) -> dict:
+    # mantém as `sample` amostras de menor chave aleatória (amostra uniforme do grupo)
+    keys = acc["rng"].random_sample(len(vals))
+    if res is None:
+        res = {"n": 0, "vals": np.empty(0), "keys": np.empty(0)}
+    res["n"] += len(vals)
+    v, k = np.concatenate([res["vals"], vals]), np.concatenate([res["keys"], keys])
+    if len(k) > acc["sample"]:
+        keep = np.argpartition(k, acc["sample"])[:acc["sample"]]
+        v, k = v[keep], k[keep]
+    res["vals"], res["keys"] = v, k
+    return res
+
+def _indices(*cols: np.ndarray) -> dict:
+    """
+    {chave: posições} das linhas sem nulos. NumPy puro: nada de objetos pandas por bloco
+    no laço de streaming.
+    """
+    import pandas as pd
+    ok = ~np.logical_or.reduce([pd.isna(c) for c in cols])
+    pos = np.flatnonzero(ok)
+    if not len(pos):
+        return {}
+    uniqs, codes = zip(*(np.unique(c[ok].astype(str), return_inverse=True) for c in cols))
+    code = codes[0].astype(np.int64)
+    for u, c in zip(uniqs[1:], codes[1:]):
+        code = code * len(u) + c
+    order = np.argsort(code, kind="stable")
+    grupos = np.split(order, np.flatnonzero(np.diff(code[order])) + 1)
+    out = {}
+    for g in grupos:
+        chave = tuple(u[c[g[0]]] for u, c in zip(uniqs, codes))
+        out[chave if len(cols) > 1 else chave[0]] = pos[g]
+    return out
+
+def update(acc: dict, projeto, job, re: np.ndarray):
+    """Acrescenta um bloco (arrays alinhados; projeto/job nulos contam só no global)."""
+    re = np.asarray(re, dtype=np.float64)
+    ok = np.isfinite(re)
+    re = re[ok]
+    projeto = np.asarray(projeto, dtype=object)[ok]
+    job = np.asarray(job, dtype=object)[ok]
+    acc["global"] = _reservoir_add(acc["global"], re, acc)
+    for p, idx in _indices(projeto).items():
+        acc["projeto"][p] = _reservoir_add(acc["projeto"].get(p), re[idx], acc)
+    for pj, idx in _indices(projeto, job).items():
+        acc["job"][pj] = _reservoir_add(acc["job"].get(pj), re[idx], acc)
+
+def finish(acc: dict, k: float = THRESH_K, min_n: int = THRESH_MIN_N) -> dict:
+    """Mesmo layout de fit_thresholds; n é a contagem real, mediana/MAD vêm do reservatório."""
+    g = acc["global"]
+    if g is None or not g["n"]:
+        raise ValueError("Sem RE válido para calcular limiares.")
+    med, scale = _robust(g["vals"])
+    scale = scale or float(np.std(g["vals"])) or 1e-12
+    out = {"k": k, "min_n": min_n,
+           "global": {"n": int(g["n"]), "median": med, "scale": scale, "thr": med + k * scale},
+           "projeto": [], "job": []}
+    for nivel, nomes in (("projeto", ("projeto",)), ("job", ("projeto", "job"))):
+        for chave, res in sorted(acc[nivel].items()):
+            if res["n"] < min_n:
+                continue
+            m, sc = _robust(res["vals"])
+            if sc > 0:
+                chave = chave if isinstance(chave, tuple) else (chave,)
+                out[nivel].append({**dict(zip(nomes, chave)), "n": int(res["n"]),
+                                   "median": m, "scale": sc, "thr": m + k * sc})
+    return out
+
+def save(thr: dict, path: str | Path = THRESHOLDS_PATH):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(thr, f, ensure_ascii=False, indent=2)
+
+def load(path: str | Path = THRESHOLDS_PATH) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _chave(v):
+    # NaN/None (sem projeto/job no execucoes.csv) não casa com nenhum grupo
+    return v if isinstance(v, str) else None
+
+def flag(projeto, job, re, thr: dict) -> tuple[np.ndarray, np.ndarray, list[str]]:
+    """
+    projeto/job/re alinhados por linha. Retorna (is_anomaly 0/1, severity, limiar_nivel):
+    limiar do projeto+job, senão do projeto, senão global.
+    severity = (re - mediana) / (k * escala), cortada em 0: >= 1 é anomalia.
+    """
+    por_job = {(g["projeto"], g["job"]): g for g in thr["job"]}
+    por_proj = {g["projeto"]: g for g in thr["projeto"]}
+    # resolve cada chave distinta uma vez; as linhas só guardam o índice da escolha
+    escolhas, vistos = [], {}
+    code = np.empty(len(re), dtype=np.int64)
+    for i, (p, j) in enumerate(zip(projeto, job)):
+        chave = (_chave(p), _chave(j))
+        c = vistos.get(chave)
+        if c is None:
+            if chave in por_job:
+                escolhas.append((por_job[chave], "job"))
+            elif chave[0] in por_proj:
+                escolhas.append((por_proj[chave[0]], "projeto"))
+            else:
+                escolhas.append((thr["global"], "global"))
+            c = vistos[chave] = len(escolhas) - 1
+        code[i] = c
+    med = np.array([g["median"] for g, _ in escolhas], dtype=np.float64)[code]
+    scale = np.array([g["scale"] for g, _ in escolhas], dtype=np.float64)[code]
+    nomes = [n for _, n in escolhas]
+
+    re = np.asarray(re, dtype=np.float64)
+    severity = np.clip((re - med) / (thr["k"] * scale), 0.0, None)
+    return (severity >= 1.0).astype(int), severity, [nomes[c] for c in code]
+
+def apply(df, thr: dict):
+    """df (DataFrame): projeto, job, re. Colunas de flag() na mesma ordem/índice de df."""
+    import pandas as pd
+    is_anomaly, severity, nivel = flag(df["projeto"].to_numpy(dtype=object),
+                                       df["job"].to_numpy(dtype=object), df["re"].to_numpy(), thr)
+    return pd.DataFrame({"is_anomaly": is_anomaly, "severity": severity, "limiar_nivel": nivel},
+                        index=df.index)
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import time
 import joblib
 import numpy as np
 import pandas as pd
@@ -9,10 +10,15 @@ from pathlib import Path
 from sklearn.neural_network import BernoulliRBM
 from sklearn.preprocessing import MinMaxScaler
 
+import rbm_lean
+import thresholds
+
 # Paths (podem ser sobrescritos por env vars)
 INPUT_FEATS = os.getenv("INPUT_FEATS", "data/features.csv")
 FEATURE_META = os.getenv("FEATURE_META", "models/feature_meta.json")
 MODEL_PATH  = os.getenv("MODEL_PATH", "models/rbm.joblib")
+LEAN_MODEL  = os.getenv("LEAN_MODEL", "models/rbm_lean.npz")   # pesos em .npz p/ rbm_lean.py
+EXECUCOES_CSV = os.getenv("EXECUCOES_CSV", "data/execucoes.csv")  # projeto/job p/ limiares
 
 # Hiperparâmetros RBM
 N_COMPONENTS  = int(os.getenv("RBM_COMPONENTS", "32"))
@@ -26,6 +32,13 @@ BINARIZE        = os.getenv("RBM_BINARIZE", "0") == "1"   # se "1", aplica limia
 BIN_THRESHOLD   = float(os.getenv("RBM_BIN_THRESHOLD", "0.5"))
 DROP_CONST_COLS = os.getenv("DROP_CONST_COLS", "1") == "1"
 
+# Treino em streaming (memória constante): 1ª passada = estatísticas, 2ª = mini-batches float32
+STREAMING      = os.getenv("RBM_STREAMING", "0") == "1"
+CHUNK_ROWS     = int(os.getenv("RBM_CHUNK_ROWS", "100000"))     # linhas por chunk do CSV
+SHUFFLE_BUFFER = int(os.getenv("RBM_SHUFFLE_BUFFER", "65536"))  # linhas embaralhadas por vez
+MEDIAN_SAMPLE  = int(os.getenv("RBM_MEDIAN_SAMPLE", "100000"))  # reservatório p/ mediana (imputação)
+MMAP_PATH      = os.getenv("RBM_MMAP_PATH", "data/features.f32")
+
 def ensure_dir(p: str | Path):
     d = Path(p).parent
     d.mkdir(parents=True, exist_ok=True)
@@ -60,7 +73,7 @@ def load_feature_meta(feats: pd.DataFrame) -> dict:
         print(f"[info] FEATURE_META criado com colunas: {num_cols}")
         return meta
 
-def preprocess_for_rbm(df: pd.DataFrame, cols: list[str]) -> np.ndarray:
+def preprocess_for_rbm(df: pd.DataFrame, cols: list[str]) -> tuple[np.ndarray, MinMaxScaler, list[str]]:
     X = df[cols].copy()
 
     # Imputação simples (mediana)
@@ -97,21 +110,169 @@ def preprocess_for_rbm(df: pd.DataFrame, cols: list[str]) -> np.ndarray:
     if np.isnan(X_out).any() or np.isinf(X_out).any():
         raise ValueError("Ainda existem NaN/inf após o pré-processamento.")
 
+    save_scalers(scaler, list(X.columns))
+    return X_out, scaler, list(X.columns)
+
+def save_scalers(scaler: MinMaxScaler, used_cols: list[str]):
     # Persistir scaler para uso futuro (opcional)
     ensure_dir("models/scalers.joblib")
     joblib.dump({"scaler": scaler, "binarize": BINARIZE, "threshold": BIN_THRESHOLD,
-                 "used_cols": list(X.columns)}, "models/scalers.joblib")
-    return X_out
+                 "used_cols": used_cols}, "models/scalers.joblib")
+
+def _iter_chunks(cols: list[str]):
+    for chunk in pd.read_csv(INPUT_FEATS, usecols=cols, chunksize=CHUNK_ROWS):
+        yield chunk[cols].apply(pd.to_numeric, errors="coerce")
+
+def stream_stats(cols: list[str]):
+    """
+    1ª passada: min/max por coluna, contagem de nulos e reservatório uniforme (tamanho fixo)
+    para a mediana de imputação. Min/max são exatos; a mediana é exata até MEDIAN_SAMPLE linhas.
+    """
+    rng = np.random.RandomState(RANDOM_STATE)
+    k = len(cols)
+    mins, maxs = np.full(k, np.inf), np.full(k, -np.inf)
+    nulls = np.zeros(k, dtype=np.int64)
+    res_vals, res_keys = np.empty((0, k)), np.empty(0)
+    n_rows = 0
+    for X in _iter_chunks(cols):
+        v = X.to_numpy(dtype=np.float64)
+        n_rows += len(v)
+        mins = np.fmin(mins, X.min().to_numpy(dtype=np.float64))
+        maxs = np.fmax(maxs, X.max().to_numpy(dtype=np.float64))
+        nulls += np.isnan(v).sum(axis=0)
+        # reservatório: mantém as MEDIAN_SAMPLE linhas com menor chave aleatória
+        res_vals = np.vstack([res_vals, v])
+        res_keys = np.concatenate([res_keys, rng.random_sample(len(v))])
+        if len(res_keys) > MEDIAN_SAMPLE:
+            keep = np.argpartition(res_keys, MEDIAN_SAMPLE)[:MEDIAN_SAMPLE]
+            res_vals, res_keys = res_vals[keep], res_keys[keep]
+    if n_rows == 0:
+        raise ValueError(f"{INPUT_FEATS} sem linhas para treinar a RBM.")
+
+    all_null = nulls == n_rows
+    medians = np.full(k, np.nan)
+    if (~all_null).any():
+        medians[~all_null] = np.nanmedian(res_vals[:, ~all_null], axis=0)
+
+    # Constante após imputação: mediana cai em [min, max], então basta min == max
+    keep = np.ones(k, dtype=bool)
+    if DROP_CONST_COLS:
+        keep = ~(all_null | (mins == maxs))
+        const_cols = [c for c, kk in zip(cols, keep) if not kk]
+        if const_cols:
+            print(f"[warn] Colunas constantes removidas: {const_cols}")
+    elif all_null.any():
+        raise ValueError("Ainda existem NaN/inf após o pré-processamento.")
+    if not keep.any():
+        raise ValueError("Não há colunas numéricas utilizáveis para treinar a RBM.")
+
+    # Mesmo MinMaxScaler do modo em RAM, ajustado só pelos extremos
+    used_cols = [c for c, kk in zip(cols, keep) if kk]
+    scaler = MinMaxScaler().fit(np.vstack([mins[keep], maxs[keep]]))
+    scaler.n_samples_seen_ = n_rows
+    return scaler, used_cols, medians[keep], n_rows
+
+def write_memmap(cols: list[str], used_cols: list[str], medians: np.ndarray,
+                 scaler: MinMaxScaler, n_rows: int) -> np.memmap:
+    """2ª passada: grava a matriz escalada em float32 num arquivo mapeado em memória."""
+    ensure_dir(MMAP_PATH)
+    X_mm = np.memmap(MMAP_PATH, dtype=np.float32, mode="w+", shape=(n_rows, len(used_cols)))
+    pos, vmin, vmax = 0, np.inf, -np.inf
+    for X in _iter_chunks(cols):
+        v = X[used_cols].to_numpy(dtype=np.float64)
+        v = np.where(np.isnan(v), medians, v)
+        v = np.clip(scaler.transform(v), 0.0, 1.0)
+        if BINARIZE:
+            v = (v >= BIN_THRESHOLD).astype(np.float64)
+        if np.isnan(v).any() or np.isinf(v).any():
+            raise ValueError("Ainda existem NaN/inf após o pré-processamento.")
+        X_mm[pos:pos + len(v)] = v
+        vmin, vmax = min(vmin, v.min()), max(vmax, v.max())
+        pos += len(v)
+    X_mm.flush()
+    print(f"[diag] X shape: {X_mm.shape}, min={vmin:.4f}, max={vmax:.4f} (memmap {MMAP_PATH})")
+    return X_mm
+
+def fit_streaming(rbm: BernoulliRBM, X_mm: np.memmap) -> BernoulliRBM:
+    """
+    N épocas de partial_fit: blocos de SHUFFLE_BUFFER linhas em ordem aleatória,
+    linhas embaralhadas dentro do bloco, lotes de tamanho uniforme (como o fit).
+    """
+    rng = np.random.RandomState(RANDOM_STATE)
+    n_rows = X_mm.shape[0]
+    buf = max(BATCH_SIZE, SHUFFLE_BUFFER // BATCH_SIZE * BATCH_SIZE)
+    starts = np.arange(0, n_rows, buf)
+    begin = time.time()
+    for epoch in range(1, N_ITER + 1):
+        for s in rng.permutation(starts):
+            block = np.asarray(X_mm[s:s + buf])
+            idx = rng.permutation(len(block))
+            for b in np.array_split(idx, int(np.ceil(len(block) / BATCH_SIZE))):
+                rbm.partial_fit(block[b])
+        if rbm.verbose:
+            pl = rbm.score_samples(np.asarray(X_mm[:buf], dtype=np.float64)).mean()
+            print(f"[BernoulliRBM] Epoch {epoch}, pseudo-likelihood = {pl:.2f}, "
+                  f"time = {time.time() - begin:.2f}s")
+    return rbm
+
+def training_re(X: np.ndarray, model: dict) -> np.ndarray:
+    """RE do próprio conjunto de treino (modo em RAM), em blocos."""
+    rng = rbm_lean.make_rng(model)
+    step = max(BATCH_SIZE, SHUFFLE_BUFFER)
+    return np.concatenate([
+        rbm_lean.reconstruction_error(np.asarray(X[s:s + step], dtype=np.float64), model, rng)
+        for s in range(0, len(X), step)
+    ])
+
+def ram_thresholds(exec_ids: pd.Series, re: np.ndarray) -> dict:
+    """Limiares exatos (mediana/MAD sobre todo o RE) a partir do join por exec_id."""
+    df = pd.DataFrame({"exec_id": exec_ids.astype(str).str.strip().to_numpy(), "re": re})
+    try:
+        keys = thresholds.read_exec_keys(EXECUCOES_CSV)[["exec_id", "projeto", "job"]]
+        df = df.merge(keys, on="exec_id", how="left")
+    except (OSError, ValueError) as e:
+        print(f"[warn] {EXECUCOES_CSV} ausente ou ilegível ({e}); apenas limiar global.")
+        df["projeto"], df["job"] = np.nan, np.nan
+    return thresholds.fit_thresholds(df)
+
+def stream_thresholds(X_mm: np.memmap, model: dict) -> dict:
+    """
+    Limiares com memória limitada: RE por bloco do memmap e projeto/job lidos em chunks do
+    execucoes.csv em paralelo. Ambos os CSVs saem do clean.csv na mesma ordem (etl/features);
+    se as linhas não baterem (exec_id ou tamanho), ficam só os limiares globais.
+    """
+    rng = rbm_lean.make_rng(model)
+    acc = thresholds.new_accumulator(RANDOM_STATE)
+    step = max(BATCH_SIZE, SHUFFLE_BUFFER)
+    has_id = "exec_id" in pd.read_csv(INPUT_FEATS, nrows=0).columns
+    ids_it = pd.read_csv(INPUT_FEATS, usecols=["exec_id"], dtype=str, chunksize=step) if has_id else None
+    ex_it = None
+    try:
+        ex_it = thresholds.read_exec_columns(EXECUCOES_CSV, ["projeto", "job", "exec_id"], chunksize=step)
+    except (OSError, ValueError) as e:
+        print(f"[warn] {EXECUCOES_CSV} ausente ou ilegível ({e}); apenas limiar global.")
+
+    for s in range(0, len(X_mm), step):
+        re = rbm_lean.reconstruction_error(np.asarray(X_mm[s:s + step], dtype=np.float64), model, rng)
+        ids = next(ids_it)["exec_id"] if ids_it is not None else None
+        projeto = job = np.full(len(re), None, dtype=object)
+        if ex_it is not None:
+            ex = next(ex_it, None)
+            # exec_id já sai sem espaços do etl/features; sem .str (o accessor cria ciclo por bloco)
+            alinhado = ex is not None and len(ex) == len(re) and (
+                ids is None or np.array_equal(ids.fillna("").to_numpy(), ex["exec_id"].fillna("").to_numpy()))
+            if alinhado:
+                projeto, job = ex["projeto"].to_numpy(), ex["job"].to_numpy()
+            else:
+                print(f"[warn] {INPUT_FEATS} e {EXECUCOES_CSV} desalinhados; apenas limiar global.")
+                acc["projeto"], acc["job"], ex_it = {}, {}, None
+        thresholds.update(acc, projeto, job, re)
+    return thresholds.finish(acc)
 
 def main():
     if not Path(INPUT_FEATS).exists():
         raise FileNotFoundError(f"Arquivo não encontrado: {INPUT_FEATS}")
 
-    feats = pd.read_csv(INPUT_FEATS)
-    meta = load_feature_meta(feats)
-
-    X = preprocess_for_rbm(feats, meta["feature_cols"])
-
     rbm = BernoulliRBM(
         n_components=N_COMPONENTS,
         learning_rate=LEARNING_RATE,
@@ -120,11 +281,48 @@ def main():
         random_state=RANDOM_STATE,
         verbose=True,
     )
-    rbm.fit(X)
+
+    if STREAMING:
+        # amostra só para inferir tipos/colunas; o resto é lido em chunks
+        meta = load_feature_meta(pd.read_csv(INPUT_FEATS, nrows=CHUNK_ROWS))
+        cols = meta["feature_cols"]
+        scaler, used_cols, medians, n_rows = stream_stats(cols)
+        X_mm = None
+        try:
+            # dentro do try: erro na 2ª passada também remove o arquivo parcial
+            X_mm = write_memmap(cols, used_cols, medians, scaler, n_rows)
+            fit_streaming(rbm, X_mm)
+            model = rbm_lean.to_model(rbm, scaler, used_cols)
+            thr = stream_thresholds(X_mm, model) if thresholds.THRESHOLDS_PATH else None
+        finally:
+            del X_mm
+            Path(MMAP_PATH).unlink(missing_ok=True)
+        save_scalers(scaler, used_cols)
+    else:
+        feats = pd.read_csv(INPUT_FEATS)
+        meta = load_feature_meta(feats)
+        X, scaler, used_cols = preprocess_for_rbm(feats, meta["feature_cols"])
+        rbm.fit(X)
+        model = rbm_lean.to_model(rbm, scaler, used_cols)
+        thr = None
+        if thresholds.THRESHOLDS_PATH:
+            exec_ids = feats.get("exec_id", pd.Series(np.arange(len(feats)).astype(str)))
+            thr = ram_thresholds(exec_ids, training_re(X, model))
 
     ensure_dir(MODEL_PATH)
     joblib.dump(rbm, MODEL_PATH)
     print(f"[train_rbm] Modelo salvo em {MODEL_PATH}")
 
+    if LEAN_MODEL:
+        # amarra o .npz aos .joblib deste treino: o detect só usa o caminho enxuto se baterem
+        model["origem_sha256"] = rbm_lean.fingerprint(MODEL_PATH, "models/scalers.joblib")
+        rbm_lean.export(LEAN_MODEL, model)
+        print(f"[train_rbm] Modelo enxuto salvo em {LEAN_MODEL}")
+
+    if thr is not None:
+        thresholds.save(thr)
+        print(f"[train_rbm] Limiares salvos em {thresholds.THRESHOLDS_PATH} "
+              f"({len(thr['job'])} jobs, {len(thr['projeto'])} projetos, global={thr['global']['thr']:.4f})")
+
 if __name__ == "__main__":
     main()